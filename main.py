@@ -1,12 +1,22 @@
+import argparse
+import cloudpickle
+import hashlib
+import importlib.util
 import json
+import logging
 import mlflow
-import tempfile
 import os
+import subprocess
+import sys
+import time
 import hydra
-import shutil
-from omegaconf import DictConfig
+import wandb
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from omegaconf import DictConfig, OmegaConf
 from hydra.utils import to_absolute_path
 
+logger = logging.getLogger(__name__)
+
 _steps = [
     "download",
     "basic_cleaning",
@@ -16,123 +26,495 @@ _steps = [
     "test_regression_model",
 ]
 
+# Local steps calling go() of their run.py in-process when main.inproc is set
+_inproc_steps = frozenset(["basic_cleaning", "train_random_forest", "test_regression_model"])
+
+# Upstream steps each step waits for. Steps that do not depend on each other (e.g.
+# data_check and data_split) are launched concurrently. Training also waits for data_check,
+# so that no model is built from data failing its tests
+_step_dag = {
+    "download": [],
+    "basic_cleaning": ["download"],
+    "data_check": ["basic_cleaning"],
+    "data_split": ["basic_cleaning"],
+    "train_random_forest": ["data_split", "data_check"],
+    "test_regression_model": ["train_random_forest"],
+}
+
+
+def _timed(step, fn):
+    """
+    Run fn and log the wall time it took, so the critical path of the pipeline is visible
+    """
+    def _wrapper():
+        logger.info("Starting step %s", step)
+        start = time.perf_counter()
+        try:
+            return fn()
+        finally:
+            logger.info("Step %s took %.1fs", step, time.perf_counter() - start)
+
+    return _wrapper
+
+
+def _run_here(fn):
+    """
+    Call fn in the current thread, returning its outcome as a completed Future
+    """
+    future = Future()
+    try:
+        future.set_result(fn())
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _run_dag(runners, active_steps, max_workers=4, exclusive=frozenset()):
+    """
+    Execute the active steps, launching each one as soon as all of its active upstream
+    steps have finished successfully. Steps whose upstream failed are not launched.
+
+    :param runners: dict mapping step name -> callable launching the step
+    :param active_steps: names of the steps to execute
+    :param max_workers: maximum number of steps running at the same time
+    :param exclusive: steps that must not run concurrently with any other step (e.g. the ones
+                      changing the process working directory, see _run_inproc). They are run
+                      on the calling thread
+    :return: None. Re-raises the exception of the first failed step, if any
+    """
+    pending = [step for step in _steps if step in active_steps]
+    futures = {}
+    skipped = []
+
+    def _failed(step):
+        if step in skipped:
+            return True
+        return step in futures and futures[step].done() and futures[step].exception() is not None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or any(not f.done() for f in futures.values()):
+            # pending is in topological order, so upstream steps are resolved first
+            for step in list(pending):
+                deps = [d for d in _step_dag[step] if d in active_steps]
+                if not all(d in skipped or (d in futures and futures[d].done()) for d in deps):
+                    continue
+                if any(_failed(d) for d in deps):
+                    logger.error("Skipping step %s: an upstream step failed", step)
+                    skipped.append(step)
+                else:
+                    running = [s for s, f in futures.items() if not f.done()]
+                    if running and (step in exclusive or any(s in exclusive for s in running)):
+                        continue
+                    if step in exclusive:
+                        # Nothing else is running: run it on this (the main) thread, as the
+                        # step code expects (matplotlib, wandb.init...)
+                        futures[step] = _run_here(_timed(step, runners[step]))
+                    else:
+                        futures[step] = executor.submit(_timed(step, runners[step]))
+                pending.remove(step)
+
+            running = [f for f in futures.values() if not f.done()]
+            if running:
+                wait(running, return_when=FIRST_COMPLETED)
+
+    for step, future in futures.items():
+        if future.exception() is not None:
+            logger.error("Step %s failed", step)
+            raise future.exception()
+
+
+def _write_if_changed(path, content):
+    """
+    Atomically write content to path, leaving the file (and its mtime) untouched if it
+    already has exactly this content
+    """
+    if os.path.exists(path):
+        with open(path) as fp:
+            if fp.read() == content:
+                return
+
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fp:
+        fp.write(content)
+    os.replace(tmp, path)
+
+
+def _source_revision(uri, version=None):
+    """
+    Return a revision identifying the code a step runs: HEAD of the remote repository for
+    components fetched from git; for local steps, the git tree of the step directory plus its
+    uncommitted changes (modified tracked files and untracked, non-ignored files).
+
+    :param uri: MLflow project URI of the step
+    :param version: git branch/tag/commit used for remote projects
+    :return: the revision, or None if it cannot be determined
+    """
+    def _git(*args):
+        return subprocess.check_output(["git", *args], cwd=uri, stderr=subprocess.DEVNULL)
+
+    try:
+        if "://" in uri:
+            repo = uri.split("#")[0]
+            out = subprocess.check_output(
+                ["git", "ls-remote", repo, version or "HEAD"], stderr=subprocess.DEVNULL
+            )
+            return out.split()[0].decode() if out else None
+
+        revision = hashlib.sha256(_git("rev-parse", "HEAD:./"))
+        revision.update(_git("diff", "HEAD", "--binary", "--", "."))
+        for path in sorted(_git("ls-files", "--others", "--exclude-standard", "-z", "--", ".").split(b"\0")):
+            if path:
+                revision.update(path)
+                with open(os.path.join(uri, path.decode()), "rb") as fp:
+                    revision.update(hashlib.sha256(fp.read()).digest())
+        return revision.hexdigest()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _cache_key(step, parameters, revision, input_digests):
+    """
+    Content-addressed key of a step execution: same step, parameters, code revision and
+    input artifact contents means the same outputs
+    """
+    params = {}
+    for k, v in parameters.items():
+        # Parameters pointing to local files (e.g. rf_config) are keyed on their content
+        if isinstance(v, str) and os.path.isfile(v):
+            with open(v, "rb") as fp:
+                v = hashlib.sha256(fp.read()).hexdigest()
+        params[k] = v
+
+    payload = {"s": step, "p": sorted(params.items()), "rev": revision, "in": input_digests}
+    return hashlib.sha256(json.dumps(payload, default=str).encode()).hexdigest()
+
+
+def _experiment_id():
+    name = os.environ.get("MLFLOW_EXPERIMENT_NAME")
+    if name:
+        experiment = mlflow.get_experiment_by_name(name)
+        if experiment is not None:
+            return experiment.experiment_id
+    return os.environ.get("MLFLOW_EXPERIMENT_ID", "0")
+
+
+def _run_inproc(step, uri, parameters):
+    """
+    Call go() of the step's run.py in this process, recorded as an MLflow run, instead of
+    spawning a new interpreter (and re-importing pandas, sklearn, wandb...) through mlflow.run.
+    Only valid for local steps using the same environment as the pipeline (env_manager="local").
+    The step runs from its own directory, so nothing else may run concurrently in this process
+    (see the exclusive argument of _run_dag).
+
+    :param step: name of the step
+    :param uri: local directory of the step
+    :param parameters: arguments for go(), as the step's argument parser would produce them
+    :return: the MLflow run id
+    """
+    client = mlflow.tracking.MlflowClient()
+    mlflow_run = client.create_run(_experiment_id(), tags={"mlflow.runName": step})
+    run_id = mlflow_run.info.run_id
+    for k, v in parameters.items():
+        client.log_param(run_id, k, v)
+
+    spec = importlib.util.spec_from_file_location(f"{step}_run", os.path.join(uri, "run.py"))
+    module = importlib.util.module_from_spec(spec)
+    # Functions of the step (e.g. delta_date_feature in a saved pipeline) are pickled by value,
+    # as they would be from __main__: the module name only exists in this process
+    sys.modules[spec.name] = module
+    cloudpickle.register_pickle_by_value(module)
+    previous_wandb_run = wandb.run
+    cwd = os.getcwd()
+    sys.path.insert(0, uri)
+    status = "FAILED"
+    try:
+        # Same working directory mlflow.run would use, as steps write local files
+        os.chdir(uri)
+        spec.loader.exec_module(module)
+        module.go(argparse.Namespace(**parameters))
+        status = "FINISHED"
+    finally:
+        # Steps do not always finish the W&B run they started, and the next wandb.init in this
+        # process would otherwise return it
+        if wandb.run is not None and wandb.run is not previous_wandb_run:
+            wandb.run.finish(exit_code=0 if status == "FINISHED" else 1)
+        os.chdir(cwd)
+        sys.path.remove(uri)
+        cloudpickle.unregister_pickle_by_value(module)
+        del sys.modules[spec.name]
+        client.set_terminated(run_id, status)
+
+    return run_id
+
+
+def _launch(step, uri, parameters, inproc, run_kwargs):
+    if inproc:
+        return _run_inproc(step, uri, parameters)
+    return mlflow.run(uri, "main", parameters=parameters, **run_kwargs).run_id
+
+
+def _require_artifacts(api, step, project, specs):
+    """
+    Fetch the W&B artifacts a step consumes, failing before the step is launched (and so
+    before its environment is set up) if any of them does not exist
+
+    :param api: wandb.Api instance
+    :param step: name of the step, for the error message
+    :param project: W&B project holding the artifacts
+    :param specs: artifacts (name:alias) to fetch
+    :return: list of wandb artifacts, in the order of specs
+    """
+    artifacts = []
+    for spec in specs:
+        try:
+            artifacts.append(api.artifact(f"{project}/{spec}"))
+        except (wandb.errors.CommError, ValueError) as e:
+            raise RuntimeError(f"Cannot run step {step}: input artifact {spec} not found ({e})") from e
+    return artifacts
+
+
+def _run_or_reuse(step, uri, parameters, project, inputs=(), outputs=(), use_cache=True, inproc=False,
+                  **run_kwargs):
+    """
+    Launch a step with mlflow.run, unless a previous successful run with the same cache key
+    exists. In that case the artifacts it produced are tagged "latest" again and the step is
+    not executed. Raises RuntimeError without launching anything if an input artifact is missing.
+
+    :param step: name of the step
+    :param uri: MLflow project URI
+    :param parameters: parameters for the MLflow project
+    :param project: W&B project holding the artifacts
+    :param inputs: W&B artifacts (name:alias) consumed by the step
+    :param outputs: names of the W&B artifacts produced by the step
+    :param use_cache: if False, always run the step
+    :param inproc: if True, call the step's go() in this process (see _run_inproc)
+    :param run_kwargs: additional keyword arguments for mlflow.run
+    :return: the MLflow run id, or None if a cached run was reused
+    """
+    api = wandb.Api()
+    input_artifacts = _require_artifacts(api, step, project, inputs)
+
+    revision = _source_revision(uri, run_kwargs.get("version")) if use_cache else None
+    if revision is None:
+        return _launch(step, uri, parameters, inproc, run_kwargs)
+
+    key = _cache_key(step, parameters, revision, [a.digest for a in input_artifacts])
+    client = mlflow.tracking.MlflowClient()
+    previous = client.search_runs(
+        experiment_ids=[_experiment_id()],
+        filter_string=f"tags.cache_key = '{key}' and attributes.status = 'FINISHED'",
+        max_results=1,
+    )
+    if previous:
+        produced = json.loads(previous[0].data.tags.get("cache_outputs", "[]"))
+        try:
+            # All fetched before retagging any, so a partial hit does not move "latest"
+            artifacts = [api.artifact(f"{project}/{spec}") for spec in produced]
+        except (wandb.errors.CommError, ValueError) as e:
+            logger.warning("Step %s: outputs of run %s are not available (%s), running it again",
+                           step, previous[0].info.run_id, e)
+        else:
+            logger.info("Step %s unchanged, reusing run %s", step, previous[0].info.run_id)
+            for artifact in artifacts:
+                if "latest" not in artifact.aliases:
+                    artifact.aliases = artifact.aliases + ["latest"]
+                    artifact.save()
+            return None
+
+    run_id = _launch(step, uri, parameters, inproc, run_kwargs)
+
+    # Remember which artifact versions this run produced, so a later hit can restore them
+    produced = [f"{name}:{api.artifact(f'{project}/{name}:latest').version}" for name in outputs]
+    client.set_tag(run_id, "cache_outputs", json.dumps(produced))
+    client.set_tag(run_id, "cache_key", key)
+    return run_id
+
+
 @hydra.main(version_base=None, config_name="config", config_path=".")
 def go(config: DictConfig):
+    # Resolve the configuration once into plain containers: no interpolation on each access,
+    # and safe to share with the step threads
+    cfg = OmegaConf.to_container(config, resolve=True)
+
     # Group runs in W&B
-    os.environ["WANDB_PROJECT"] = config["main"]["project_name"]
-    os.environ["WANDB_RUN_GROUP"] = config["main"]["experiment_name"]
+    os.environ["WANDB_PROJECT"] = cfg["main"]["project_name"]
+    os.environ["WANDB_RUN_GROUP"] = cfg["main"]["experiment_name"]
+
+    # Prevent MLflow from probing git on the local subprojects, so they can be run in place
+    os.environ["MLFLOW_ENABLE_GIT_TRACKING"] = "false"
+
+    # Pin the tracking store to an absolute location: a relative one (like the default ./mlruns)
+    # would be resolved against the directory of whichever step is running in-process
+    tracking_uri = mlflow.get_tracking_uri()
+    if "://" not in tracking_uri and not tracking_uri.startswith("file:"):
+        tracking_uri = os.path.abspath(tracking_uri)
+    os.environ["MLFLOW_TRACKING_URI"] = tracking_uri
+    mlflow.set_tracking_uri(tracking_uri)
 
     # Steps to execute
-    steps_par = config["main"]["steps"]
-    active_steps = steps_par.split(",") if steps_par != "all" else _steps
-
-    with tempfile.TemporaryDirectory() as tmp_dir:
-
-        # -------- download --------
-        if "download" in active_steps:
-            _ = mlflow.run(
-                f"{config['main']['components_repository']}/get_data",
-                "main",
-                version="main",
-                parameters={
-                    "sample": config["etl"]["sample"],
-                    "artifact_name": "sample.csv",
-                    "artifact_type": "raw_data",
-                    "artifact_description": "Raw file as downloaded",
-                },
-                env_manager="local",
-            )
+    steps_par = cfg["main"]["steps"]
+    active_steps = frozenset(_steps if steps_par == "all" else steps_par.split(","))
+    unknown = active_steps - frozenset(_steps)
+    if unknown:
+        raise ValueError(f"Unknown steps: {', '.join(sorted(unknown))}. Valid steps are: {', '.join(_steps)}")
 
-        # ----- basic_cleaning -----
-        if "basic_cleaning" in active_steps:
-            _ = mlflow.run(
-                os.path.join(to_absolute_path("src"), "basic_cleaning"),
-                "main",
-                parameters={
-                    "input_artifact": "sample.csv:latest",
-                    "output_artifact": "clean_sample.csv",
-                    "output_type": "clean_sample",
-                    "output_description": "Cleaned sample (price filter, parsed dates, geo bounds)",
-                    "min_price": config["etl"]["min_price"],
-                    "max_price": config["etl"]["max_price"],
-                },
-                env_manager="local",
-            )
+    project = cfg["main"]["project_name"]
+    use_cache = cfg["main"].get("cache", True)
+    # Run the local steps sharing the pipeline environment in this process
+    inproc = cfg["main"].get("inproc", True)
+    if inproc and cfg["main"].get("single_wandb_run", False):
+        raise ValueError("main.inproc and main.single_wandb_run cannot be enabled together")
 
-        # -------- data_check -------
-        if "data_check" in active_steps:
-            _ = mlflow.run(
-                os.path.join(to_absolute_path("src"), "data_check"),
-                "main",
-                parameters={
-                    "csv": "clean_sample.csv:latest",
-                    "ref": "clean_sample.csv:reference",
-                    "kl_threshold": config["data_check"]["kl_threshold"],
-                    "min_price": config["etl"]["min_price"],
-                    "max_price": config["etl"]["max_price"],
-                },
-                env_manager="local",
-            )
+    # Optionally log every step into one W&B run. The steps resume it through
+    # WANDB_RUN_ID/WANDB_RESUME when they call wandb.init. W&B expects a single writer per run,
+    # so the pipeline does not keep it open and the steps are run one at a time
+    single_wandb_run = cfg["main"].get("single_wandb_run", False)
+    if single_wandb_run:
+        parent = wandb.init(
+            project=project, group=cfg["main"]["experiment_name"], job_type="pipeline"
+        )
+        os.environ["WANDB_RUN_ID"] = parent.id
+        os.environ["WANDB_RESUME"] = "allow"
+        parent.finish()
 
-        # -------- data_split -------
-        if "data_split" in active_steps:
-            _ = mlflow.run(
-                f"{config['main']['components_repository']}/train_val_test_split",
-                "main",
-                parameters={
-                    "input": "clean_sample.csv:latest",     
-                    "test_size":   config["modeling"]["test_size"],
-                    "random_seed": config["modeling"]["random_seed"],
-                    "stratify_by": config["modeling"]["stratify_by"],
-                },
-                env_manager="conda",
-            )
+    # -------- download --------
+    def _run_download():
+        return _run_or_reuse(
+            "download",
+            f"{cfg['main']['components_repository']}/get_data",
+            version="main",
+            parameters={
+                "sample": cfg["etl"]["sample"],
+                "artifact_name": "sample.csv",
+                "artifact_type": "raw_data",
+                "artifact_description": "Raw file as downloaded",
+            },
+            project=project,
+            outputs=["sample.csv"],
+            use_cache=use_cache,
+            env_manager="local",
+        )
 
-        # --- train_random_forest ---
-        if "train_random_forest" in active_steps:
-            rf_config = os.path.abspath("rf_config.json")
-            with open(rf_config, "w+") as fp:
-                json.dump(dict(config["modeling"]["random_forest"].items()), fp)
-
-            src_train = os.path.join(to_absolute_path("src"), "train_random_forest")
-            train_proj = os.path.join(tmp_dir, "train_random_forest")
-            shutil.copytree(src_train, train_proj)
-            os.environ["MLFLOW_ENABLE_GIT_TRACKING"] = "false"
-
-
-            _ = mlflow.run(
-                train_proj,
-                "main",
-                parameters={
-                    "rf_config": rf_config,
-                    "trainval_artifact": "trainval_data.csv:latest",
-                    "val_size":   config["modeling"]["val_size"],
-                    "random_seed":config["modeling"]["random_seed"],
-                    "stratify_by":config["modeling"]["stratify_by"],
-                    "max_tfidf_features": config["modeling"]["max_tfidf_features"],
-                    "output_artifact": "random_forest_export",
-                },
-                env_manager="local",
-            )
+    # ----- basic_cleaning -----
+    def _run_basic_cleaning():
+        return _run_or_reuse(
+            "basic_cleaning",
+            os.path.join(to_absolute_path("src"), "basic_cleaning"),
+            parameters={
+                "input_artifact": "sample.csv:latest",
+                "output_artifact": "clean_sample.csv",
+                "output_type": "clean_sample",
+                "output_description": "Cleaned sample (price filter, parsed dates, geo bounds)",
+                "min_price": cfg["etl"]["min_price"],
+                "max_price": cfg["etl"]["max_price"],
+            },
+            project=project,
+            inputs=["sample.csv:latest"],
+            outputs=["clean_sample.csv"],
+            use_cache=use_cache,
+            inproc=inproc,
+            env_manager="local",
+        )
 
-        # test_regression_model
-        if "test_regression_model" in active_steps:
-            src_test = os.path.join(to_absolute_path("src"), "test_regression_model")
-            test_proj = os.path.join(tmp_dir, "test_regression_model")
-            shutil.copytree(src_test, test_proj)
-
-    # prevent MLflow from probing git on this local subproject
-            os.environ["MLFLOW_ENABLE_GIT_TRACKING"] = "false"
-            _ = mlflow.run(
-                test_proj,
-                "main",
-                parameters={
-                    "model_export": "random_forest_export:prod",
-                    "test_data": "test_data.csv:latest",
-                    "target": "price",  # or config["modeling"]["target"] if you add it
+    # -------- data_check -------
+    def _run_data_check():
+        return _run_or_reuse(
+            "data_check",
+            os.path.join(to_absolute_path("src"), "data_check"),
+            parameters={
+                "csv": "clean_sample.csv:latest",
+                "ref": "clean_sample.csv:reference",
+                "kl_threshold": cfg["data_check"]["kl_threshold"],
+                "min_price": cfg["etl"]["min_price"],
+                "max_price": cfg["etl"]["max_price"],
             },
+            project=project,
+            inputs=["clean_sample.csv:latest", "clean_sample.csv:reference"],
+            use_cache=use_cache,
             env_manager="local",
         )
 
+    # -------- data_split -------
+    def _run_data_split():
+        return _run_or_reuse(
+            "data_split",
+            f"{cfg['main']['components_repository']}/train_val_test_split",
+            parameters={
+                "input": "clean_sample.csv:latest",
+                "test_size":   cfg["modeling"]["test_size"],
+                "random_seed": cfg["modeling"]["random_seed"],
+                "stratify_by": cfg["modeling"]["stratify_by"],
+            },
+            project=project,
+            inputs=["clean_sample.csv:latest"],
+            outputs=["trainval_data.csv", "test_data.csv"],
+            use_cache=use_cache,
+            env_manager="conda",
+        )
+
+    # --- train_random_forest ---
+    def _run_train_random_forest():
+        rf_config = os.path.abspath("rf_config.json")
+        _write_if_changed(
+            rf_config, json.dumps(cfg["modeling"]["random_forest"], sort_keys=True)
+        )
+
+        return _run_or_reuse(
+            "train_random_forest",
+            os.path.join(to_absolute_path("src"), "train_random_forest"),
+            parameters={
+                "rf_config": rf_config,
+                "trainval_artifact": "trainval_data.csv:latest",
+                "val_size":   cfg["modeling"]["val_size"],
+                "random_seed":cfg["modeling"]["random_seed"],
+                "stratify_by":cfg["modeling"]["stratify_by"],
+                "max_tfidf_features": cfg["modeling"]["max_tfidf_features"],
+                "output_artifact": "random_forest_export",
+            },
+            project=project,
+            inputs=["trainval_data.csv:latest"],
+            outputs=["random_forest_export"],
+            use_cache=use_cache,
+            inproc=inproc,
+            env_manager="local",
+        )
+
+    # test_regression_model
+    def _run_test_regression_model():
+        if cfg["main"].get("offline_test", False):
+            # Last step of the DAG: no step is launched after it with this environment
+            os.environ["WANDB_MODE"] = "offline"
+        return _run_or_reuse(
+            "test_regression_model",
+            os.path.join(to_absolute_path("src"), "test_regression_model"),
+            parameters={
+                "model_export": "random_forest_export:prod",
+                "test_data": "test_data.csv:latest",
+                "target": "price",  # or cfg["modeling"]["target"] if you add it
+                "quantize_infer": cfg["modeling"].get("quantize_infer", False),
+                "exact": cfg["modeling"].get("exact_metrics", False),
+            },
+            project=project,
+            inputs=["random_forest_export:prod", "test_data.csv:latest"],
+            use_cache=use_cache,
+            inproc=inproc,
+            env_manager="local",
+        )
+
+    _run_dag(
+        {
+            "download": _run_download,
+            "basic_cleaning": _run_basic_cleaning,
+            "data_check": _run_data_check,
+            "data_split": _run_data_split,
+            "train_random_forest": _run_train_random_forest,
+            "test_regression_model": _run_test_regression_model,
+        },
+        active_steps,
+        max_workers=1 if single_wandb_run else 4,
+        # In-process steps change the working directory: run them alone
+        exclusive=_inproc_steps if inproc else frozenset(),
+    )
+
 if __name__ == "__main__":
     go()
@@ -1,19 +1,92 @@
 import argparse
+import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.feather as feather
 import wandb
 import mlflow.sklearn as msk
 from sklearn.metrics import mean_absolute_error, r2_score, mean_squared_error
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, metrics fall back to scikit-learn
+    njit = None
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger("test_regression_model")
 
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _fused_metrics(y, p):
+        # MAE, RMSE, sum of squared errors and total sum of squares in a single pass over (y, p)
+        n = y.shape[0]
+        sae = 0.0
+        sse = 0.0
+        sy = 0.0
+        syy = 0.0
+        for i in prange(n):
+            e = y[i] - p[i]
+            sae += abs(e)
+            sse += e * e
+            sy += y[i]
+            syy += y[i] * y[i]
+        sst = syy - sy * sy / n
+        if sst <= 1e-12 * syy:
+            # constant y, up to the rounding of the one-pass formula
+            sst = 0.0
+        return sae / n, (sse / n) ** 0.5, sse, sst
+
+def _r2(sse, sst):
+    # Same convention as sklearn's r2_score for a constant target
+    if sst == 0.0:
+        return 1.0 if sse == 0.0 else 0.0
+    return 1.0 - sse / sst
+
+def _regression_metrics(y, preds, exact=False):
+    """
+    Return (mae, rmse, r2) of preds against y. With exact=True use the scikit-learn
+    implementations, e.g. to validate the fast paths.
+    """
+    if exact:
+        mae = float(mean_absolute_error(y, preds))
+        rmse = float(np.sqrt(mean_squared_error(y, preds)))
+        r2 = float(r2_score(y, preds))
+        return mae, rmse, r2
+
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    preds = np.ascontiguousarray(preds, dtype=np.float64)
+    if njit is not None:
+        mae, rmse, sse, sst = _fused_metrics(y, preds)
+        return float(mae), float(rmse), float(_r2(sse, sst))
+
+    # A single error buffer, reused in place for all the metrics
+    err = np.empty_like(y)
+    np.subtract(y, preds, out=err)
+    np.abs(err, out=err)
+    mae = err.mean()
+    np.square(err, out=err)
+    sse = err.sum()
+    np.subtract(y, y.mean(), out=err)
+    np.square(err, out=err)
+    r2 = _r2(sse, err.sum())
+    return float(mae), float(np.sqrt(sse / y.shape[0])), float(r2)
+
 def _resolve_mlflow_model_dir(root: str) -> str:
     """
     Find the MLflow model directory (contains 'MLmodel') inside a wandb artifact download.
+    Uses the layout.json manifest written at training time; older artifacts without it
+    are searched.
     """
+    try:
+        with open(os.path.join(root, "layout.json")) as fp:
+            return os.path.normpath(os.path.join(root, json.load(fp)["mlflow_dir"]))
+    except (OSError, KeyError, ValueError):
+        pass
     # direct path?
     if os.path.isfile(os.path.join(root, "MLmodel")):
         return root
@@ -28,35 +101,123 @@ def _resolve_mlflow_model_dir(root: str) -> str:
             return candidate
     raise FileNotFoundError("Could not locate MLflow model directory (no 'MLmodel' file found).")
 
+def _read_test_data(test_csv: str) -> pd.DataFrame:
+    """
+    Parse the test CSV with pyarrow's multi-threaded reader, keeping the dtypes pd.read_csv would
+    give. The parsed table is cached as Feather next to the CSV (i.e. per artifact version) so
+    later runs memory-map it instead of parsing the text again.
+    """
+    cache = test_csv + ".feather"
+    if os.path.isfile(cache):
+        table = feather.read_table(cache, memory_map=True)
+    else:
+        table = pacsv.read_csv(
+            test_csv,
+            read_options=pacsv.ReadOptions(use_threads=True),
+            convert_options=pacsv.ConvertOptions(strings_can_be_null=True),
+        )
+        # pandas does not parse dates unless asked to: keep them as strings, as during training
+        for i, field in enumerate(table.schema):
+            if pa.types.is_temporal(field.type):
+                table = table.set_column(i, field.name, table.column(i).cast(pa.string()))
+        # Written aside and moved in place, so an interrupted write never leaves a corrupt cache
+        tmp = cache + ".tmp"
+        feather.write_feather(table, tmp, compression="uncompressed")
+        os.replace(tmp, cache)
+
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    # pyarrow gives None for missing strings, pandas gives NaN: fix the object columns in place
+    for col in df.columns[df.dtypes == object]:
+        values = df[col].to_numpy()
+        values[pd.isna(values)] = np.nan
+    return df
+
+def _enable_parallel_predict(model):
+    """
+    Let the final estimator of the pipeline predict on all cores. RandomForest parallelizes
+    prediction across trees with threads. Rows are not split in chunks because the date
+    feature is computed relative to the most recent date of the batch being transformed.
+    """
+    estimator = model.steps[-1][1] if hasattr(model, "steps") else model
+    if "n_jobs" in estimator.get_params(deep=False):
+        estimator.set_params(n_jobs=-1)
+
+class _QuantizedForest:
+    """
+    Prediction-only stand-in for a fitted RandomForestRegressor that keeps the leaf values of
+    all the trees as int16 (with one forest-wide scale) instead of float64, so the values
+    gathered for each row take 4x less memory bandwidth. Leaves are still found by the
+    forest's own tree traversal (apply).
+    """
+
+    def __init__(self, forest):
+        self.forest = forest
+        # single-output regression: tree_.value has shape (n_nodes, 1, 1)
+        values = [est.tree_.value[:, 0, 0] for est in forest.estimators_]
+        max_abs = max(np.abs(v).max() for v in values)
+        self.scale = max_abs / 32767 if max_abs > 0 else 1.0
+        # Leaf values of all trees in one array, tree t starting at offsets[t]
+        self.offsets = np.cumsum([0] + [v.shape[0] for v in values[:-1]])
+        self.values = np.concatenate([np.round(v / self.scale) for v in values]).astype(np.int16)
+
+    def predict(self, X):
+        leaves = self.forest.apply(X)  # (n_samples, n_trees) leaf index in each tree
+        quantized = self.values[leaves + self.offsets]
+        return quantized.sum(axis=1, dtype=np.int32) * (self.scale / leaves.shape[1])
+
 def go(args):
-    run = wandb.init(job_type="test_regression_model")
-    run.config.update(vars(args))
-
-    # Fetch model artifact (directory)
-    logger.info("Downloading model artifact: %s", args.model_export)
-    model_art = run.use_artifact(args.model_export)
-    model_root = model_art.download()
-    model_path = _resolve_mlflow_model_dir(model_root)
-    logger.info("Loading model from %s", model_path)
-    model = msk.load_model(model_path)
-
-    # Fetch test data CSV
-    logger.info("Downloading test data artifact: %s", args.test_data)
-    test_art = run.use_artifact(args.test_data)
-    test_csv = test_art.file()
-    df = pd.read_csv(test_csv)
-
-    y = df[args.target].values
-    X = df.drop(columns=[args.target])
+    # This step only computes metrics: when the caller asks for it (WANDB_MODE=offline, or
+    # WANDB_DISABLED=true for local smoke tests) the run is only written to the local directory
+    mode = os.environ.get("WANDB_MODE", "online")
+    if os.environ.get("WANDB_DISABLED", "").lower() == "true":
+        mode = "offline"
+    # Config is sent with the init call, so it is uploaded while the model is scored
+    run = wandb.init(job_type="test_regression_model", mode=mode, config=vars(args))
+
+    def _use_artifact(name):
+        # An offline run cannot fetch artifacts: read them through the public API instead
+        # (the lineage is then not recorded)
+        if mode == "offline":
+            return wandb.Api().artifact(f"{os.environ.get('WANDB_PROJECT', run.project)}/{name}")
+        return run.use_artifact(name)
+
+    def _fetch_model():
+        # Fetch model artifact (directory)
+        logger.info("Downloading model artifact: %s", args.model_export)
+        model_root = _use_artifact(args.model_export).download()
+        model_path = _resolve_mlflow_model_dir(model_root)
+        logger.info("Loading model from %s", model_path)
+        model = msk.load_model(model_path)
+        _enable_parallel_predict(model)
+        return model
+
+    def _fetch_test_data():
+        # Fetch test data CSV
+        logger.info("Downloading test data artifact: %s", args.test_data)
+        test_csv = _use_artifact(args.test_data).file()
+        return _read_test_data(test_csv)
+
+    # The two artifacts are independent: download and load them concurrently
+    with ThreadPoolExecutor(2) as ex:
+        f_model = ex.submit(_fetch_model)
+        f_test = ex.submit(_fetch_test_data)
+        model, df = f_model.result(), f_test.result()
+
+    # pop removes the target in place, so X is not a copy of the remaining columns
+    y = df.pop(args.target).to_numpy()
+    X = df
 
     logger.info("Scoring on hold-out")
-    preds = model.predict(X)
-    mae = float(mean_absolute_error(y, preds))
-    rmse = float(np.sqrt(mean_squared_error(y, preds)))
-    r2  = float(r2_score(y, preds))
+    if args.quantize_infer:
+        # The wrapper is not an sklearn estimator: keep it out of the pipeline and feed it
+        # the output of the preprocessing steps
+        preds = _QuantizedForest(model.steps[-1][1]).predict(model[:-1].transform(X))
+    else:
+        preds = model.predict(X)
+    mae, rmse, r2 = _regression_metrics(y, preds, exact=args.exact)
 
     logger.info("MAE=%.4f RMSE=%.4f R2=%.4f", mae, rmse, r2)
-    wandb.log({"mae_test": mae, "rmse_test": rmse, "r2_test": r2})
+    wandb.log({"mae_test": mae, "rmse_test": rmse, "r2_test": r2}, commit=True)
     run.finish()
 
 if __name__ == "__main__":
@@ -64,5 +225,9 @@ if __name__ == "__main__":
     p.add_argument("--model_export", type=str, required=True, help="Model artifact, e.g. random_forest_export:prod")
     p.add_argument("--test_data", type=str, required=True, help="Test CSV artifact, e.g. data_test.csv:latest")
     p.add_argument("--target", type=str, required=True, help="Target column name (e.g., price)")
+    p.add_argument("--quantize_infer", type=lambda s: s.lower() == "true", default=False,
+                   help="Predict with int16-quantized leaf values (true/false)")
+    p.add_argument("--exact", type=lambda s: s.lower() == "true", default=False,
+                   help="Compute the metrics with scikit-learn instead of the fast paths (true/false)")
     args = p.parse_args()
     go(args)
@@ -111,6 +111,10 @@ def go(args):
         metadata = rf_config
     )
     artifact.add_dir('random_forest_dir')
+    # Tell consumers where the MLflow model lives inside the artifact (add_dir puts the
+    # content of random_forest_dir at the root), so they do not have to search for it
+    with artifact.new_file('layout.json') as fp:
+        json.dump({"mlflow_dir": "."}, fp)
     run.log_artifact(artifact)
 
     # Plot feature importance
@@ -129,6 +133,8 @@ def go(args):
           "feature_importance": wandb.Image(fig_feat_imp),
         }
     )
+    # The step may run inside the long-lived pipeline process: release the figure
+    plt.close(fig_feat_imp)
 
 
 def plot_feature_importance(pipe, feat_names):